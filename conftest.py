@@ -16,3 +16,8 @@ def pytest_runtest_makereport(item, call):
     # be "setup", "call", "teardown"
 
     setattr(item, "rep_" + rep.when, rep)
+
+    # Attach the bitcoind proxy metrics exported by the `bitcoind` fixture
+    # to the test in the JSON report.
+    if rep.when == "teardown" and hasattr(item, "bitcoind_metrics"):
+        rep.test_metadata = {"bitcoind_metrics": item.bitcoind_metrics}
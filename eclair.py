@@ -85,12 +85,10 @@ class EclairD(TailableProc):
 
     def start(self):
         TailableProc.start(self)
-        self.wait_for_log("connected to tcp://127.0.0.1:")
-
         # And let's also remember the address
         exp = 'initial wallet address=([a-zA-Z0-9]+)'
-        addr_line = self.wait_for_log(exp)
-        self.addr = re.search(exp, addr_line).group(1)
+        matches = self.wait_for_logs(["connected to tcp://127.0.0.1:", exp])
+        self.addr = re.search(exp, matches[exp].line.text).group(1)
 
         self.logger.info("Eclair started (pid: {})".format(self.proc.pid))
 
@@ -109,13 +107,15 @@ class EclairD(TailableProc):
         for p in alive:
             p.kill()
         psutil.wait_procs(alive, timeout=3)
-        self.thread.join()
+        self.join_tail()
         super().save_log()
 
 
 class EclairNode(object):
 
     displayName = 'eclair'
+    # Follows bitcoind over ZMQ, which replayed journals can't provide
+    uses_zmq = True
 
     def __init__(self, lightning_dir, lightning_port, btc, executor=None,
                  node_id=0):
@@ -150,6 +150,11 @@ class EclairNode(object):
         time.sleep(1)
         bitcoind.rpc.generate(1)
 
+    def wait_for_funds(self, satoshis):
+        # Eclair funds channels from bitcoind's wallet, which knows about
+        # the funds as soon as bitcoind does.
+        pass
+
     def ping(self):
         """ Simple liveness test to see if the node is up and running
 
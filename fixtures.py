@@ -1,10 +1,20 @@
-from btcproxy import ProxiedBitcoinD
+from btcproxy import AsyncProxiedBitcoinD, ProxiedBitcoinD
 from ephemeral_port_reserve import reserve
 from concurrent import futures
-
+from hashlib import sha256
+from urllib.parse import quote
+from utils import BitcoinD, BitcoinRpc, BITCOIND_CONFIG, bitcoind_version, clone_dir
+from utils import sync_blockheight, wait_for
+
+import collections
+import glob
+import importlib
+import json
 import os
 import pytest
 import tempfile
+import threading
+import time
 import logging
 import shutil
 
@@ -12,39 +22,385 @@ import shutil
 TEST_DIR = tempfile.mkdtemp(prefix='lightning-')
 TEST_DEBUG = os.getenv("TEST_DEBUG", "0") == "1"
 
+# Share one bitcoind per pytest worker and give each test its own wallet
+# instead of starting a fresh bitcoind for every test.
+TEST_SHARED_BITCOIND = os.getenv("TEST_SHARED_BITCOIND", "0") == "1"
+
+# Cache replies to deterministic calls in the bitcoind proxy
+TEST_PROXY_CACHE = os.getenv("TEST_PROXY_CACHE", "0") == "1"
+
+# Attribute the calls through the bitcoind proxy to the nodes making them
+# in the exported metrics. This scans the connections of all processes
+# for every new connection, so it slows the proxy down.
+TEST_PROXY_CLIENTS = os.getenv("TEST_PROXY_CLIENTS", "0") == "1"
+
+# Serve the bitcoind proxy from an asyncio event loop instead of a thread pool
+TEST_ASYNC_PROXY = os.getenv("TEST_ASYNC_PROXY", "0") == "1"
+
+# Record the calls through the bitcoind proxy of every test to a journal
+# with TEST_BITCOIND_JOURNAL=record, and answer them from the journal
+# without starting bitcoind at all with TEST_BITCOIND_JOURNAL=replay.
+TEST_BITCOIND_JOURNAL = os.getenv("TEST_BITCOIND_JOURNAL", "")
+JOURNAL_DIR = os.getenv("TEST_JOURNAL_DIR", os.path.join(os.path.dirname(__file__), "journals"))
+
+# Keep this many started nodes of each implementation ready for the next
+# test to lease. Needs TEST_SHARED_BITCOIND=1, since the nodes outlive tests.
+TEST_NODE_POOL = int(os.getenv("TEST_NODE_POOL", "0"))
+
+# Name of the wallet funding the per-test wallets of a shared bitcoind
+FUNDER_WALLET = "funder"
+
+# How many bitcoins each test gets from the funder, tests return what is
+# left of them when they are done.
+TEST_WALLET_FUNDS = 10
+
 
 # A dict in which we count how often a particular test has run so far. Used to
 # give each attempt its own numbered directory, and avoid clashes.
 __attempts = {}
 
 
+class NodePool(object):
+    """A pool of started, unfunded and unconnected nodes.
+
+    Tests lease nodes instead of waiting for them to start. Leased nodes
+    are not given back, since tests fund them and open channels, instead
+    the pool starts replacements in the background, keeping up to `size`
+    idle nodes of every implementation that has been leased so far.
+
+    """
+    def __init__(self, directory, bitcoind, size):
+        self.directory = directory
+        self.bitcoind = bitcoind
+        self.size = size
+        self.next_id = 1
+        self.idle = {}
+        self.starting = collections.Counter()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.executor = futures.ThreadPoolExecutor(max_workers=20)
+
+    def _start(self, implementation):
+        with self.lock:
+            node_id = self.next_id
+            self.next_id += 1
+
+        lightning_dir = os.path.join(self.directory, "node-{}/".format(node_id))
+        node = implementation(lightning_dir, reserve(), self.bitcoind,
+                              executor=self.executor, node_id=node_id)
+        try:
+            node.daemon.start()
+        except Exception:
+            # Nobody else knows about the node, so clean up after it here
+            if node.daemon.proc is not None:
+                node.daemon.stop()
+            raise
+        self.bitcoind.name_client(
+            node.daemon.proc.pid, "{}-pool-{}".format(node.displayName, node_id))
+        return node
+
+    def _warm(self, implementation):
+        try:
+            node = self._start(implementation)
+        except Exception:
+            logging.exception("Could not start a %s node for the pool", implementation.displayName)
+            node = None
+
+        with self.lock:
+            self.starting[implementation] -= 1
+            if node is not None and not self.closed:
+                self.idle[implementation].append(node)
+                return
+        if node is not None:
+            node.daemon.stop()
+
+    def _refill(self):
+        with self.lock:
+            if self.closed:
+                return
+            for implementation, idle in self.idle.items():
+                while len(idle) + self.starting[implementation] < self.size:
+                    self.starting[implementation] += 1
+                    self.executor.submit(self._warm, implementation)
+
+    def lease(self, implementation):
+        """Return a started node of `implementation`.
+
+        If no node is idle we start one right away rather than waiting
+        for the refill, which is kicked off either way.
+        """
+        with self.lock:
+            idle = self.idle.setdefault(implementation, [])
+            node = idle.pop(0) if idle else None
+        self._refill()
+        if node is None:
+            node = self._start(implementation)
+        return node
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.executor.shutdown(wait=True)
+        for idle in self.idle.values():
+            for node in idle:
+                node.daemon.stop()
+        self.idle = {}
+
+
 class NodeFactory(object):
     """A factory to setup and start `lightningd` daemons.
     """
-    def __init__(self, testname, executor, bitcoind, btcd):
+    def __init__(self, testname, executor, bitcoind, btcd, pool=None):
         self.testname = testname
         self.next_id = 1
         self.nodes = []
         self.executor = executor
         self.bitcoind = bitcoind
         self.btcd = btcd
+        self.pool = pool
 
-    def get_node(self, implementation):
+    def _new_node(self, implementation, datadir=None):
+        """Allocate a directory and port for a new node, without starting it.
+
+        The node starts out with a copy of `datadir` if given. Its
+        configuration is still written from scratch, with fresh ports.
+        """
         node_id = self.next_id
         self.next_id += 1
 
         lightning_dir = os.path.join(
             TEST_DIR, self.testname, "node-{}/".format(node_id))
         port = reserve()
+        if datadir is not None:
+            clone_dir(datadir, lightning_dir)
+            for log in glob.glob(os.path.join(lightning_dir, "log.*")):
+                os.remove(log)
 
         node = implementation(lightning_dir, port, self.bitcoind,
                               executor=self.executor, node_id=node_id)
         self.nodes.append(node)
 
         node.btcd = self.btcd
+        return node_id, node
+
+    def _start_node(self, node_id, node):
         node.daemon.start()
+        self.bitcoind.name_client(
+            node.daemon.proc.pid, "{}-{}".format(node.displayName, node_id))
+        return node
+
+    def _lease_node(self, node_id, implementation):
+        node = self.pool.lease(implementation)
+        self.nodes.append(node)
+
+        node.btcd = self.btcd
+        self.bitcoind.name_client(
+            node.daemon.proc.pid, "{}-{}".format(node.displayName, node_id))
         return node
 
+    def get_node(self, implementation):
+        if self.pool is not None:
+            return self.get_nodes([implementation])[0]
+        return self._start_node(*self._new_node(implementation))
+
+    def get_nodes(self, implementations):
+        """Start a node for each of `implementations` concurrently.
+
+        Returns the nodes, in the order of `implementations`, once all of
+        them are ready. If any of them fails to start we still wait for
+        the others, so that `killall` can clean up after all of them.
+        With a `NodePool` the nodes are leased from the pool instead.
+
+        """
+        if self.pool is not None:
+            node_ids = range(self.next_id, self.next_id + len(implementations))
+            self.next_id += len(implementations)
+            starts = [self.executor.submit(self._lease_node, node_id, impl)
+                      for node_id, impl in zip(node_ids, implementations)]
+        else:
+            nodes = [self._new_node(impl) for impl in implementations]
+            starts = [self.executor.submit(self._start_node, node_id, node)
+                      for node_id, node in nodes]
+        futures.wait(starts)
+        return [f.result() for f in starts]
+
+    def snapshot(self, name, nodes):
+        """Archive the state of `nodes` and bitcoind as snapshot `name`.
+
+        The nodes and bitcoind are stopped while we copy their data
+        directories. Afterwards bitcoind is restarted, but the nodes are
+        not, `restore` brings them back. Snapshots are kept for the rest
+        of the session.
+
+        """
+        if TEST_SHARED_BITCOIND:
+            raise ValueError("Snapshots need a bitcoind of their own")
+
+        directory = os.path.join(TEST_DIR, "snapshots", name)
+        ids = [n.id() for n in nodes]
+        edges = set()
+        for i, n in enumerate(nodes):
+            for peer in n.peers():
+                if peer in ids:
+                    edges.add(tuple(sorted((i, ids.index(peer)))))
+
+        for n in nodes:
+            n.daemon.stop()
+            self.nodes.remove(n)
+        # The daemons may still be writing to their directories until
+        # they actually exited.
+        for n in nodes:
+            n.daemon.proc.wait()
+
+        def archive():
+            # Leftovers of a snapshot that failed halfway would make
+            # `clone_dir` copy into the existing directories.
+            shutil.rmtree(directory, ignore_errors=True)
+            clone_dir(os.path.join(self.bitcoind.bitcoin_dir, "regtest"),
+                      os.path.join(directory, "bitcoind"))
+            for i, n in enumerate(nodes):
+                clone_dir(n.daemon.lightning_dir, os.path.join(directory, "node-{}".format(i)))
+
+        self.bitcoind.restart(archive)
+
+        manifest = {
+            'nodes': ["{}:{}".format(type(n).__module__, type(n).__name__) for n in nodes],
+            'edges': sorted(edges),
+        }
+        with open(os.path.join(directory, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+    def has_snapshot(self, name):
+        return os.path.exists(os.path.join(TEST_DIR, "snapshots", name, "manifest.json"))
+
+    def restore(self, name):
+        """Start the nodes archived as snapshot `name`, see `snapshot`.
+
+        bitcoind is restarted on the archived chain, and the nodes get
+        new directories and ports. Since the nodes remember their peers
+        by their old ports we reconnect them, and return the nodes, in
+        the order they were passed to `snapshot`, once all channels
+        between them are active again.
+
+        """
+        if TEST_SHARED_BITCOIND:
+            raise ValueError("Snapshots need a bitcoind of their own")
+
+        directory = os.path.join(TEST_DIR, "snapshots", name)
+        with open(os.path.join(directory, "manifest.json")) as f:
+            manifest = json.load(f)
+
+        def unpack():
+            regtest_dir = os.path.join(self.bitcoind.bitcoin_dir, "regtest")
+            shutil.rmtree(regtest_dir)
+            clone_dir(os.path.join(directory, "bitcoind"), regtest_dir)
+            if os.path.exists(os.path.join(regtest_dir, "debug.log")):
+                os.remove(os.path.join(regtest_dir, "debug.log"))
+
+        self.bitcoind.restart(unpack)
+
+        nodes = []
+        for i, impl in enumerate(manifest['nodes']):
+            module, cls = impl.split(':')
+            implementation = getattr(importlib.import_module(module), cls)
+            nodes.append(self._new_node(
+                implementation, os.path.join(directory, "node-{}".format(i))))
+        starts = [self.executor.submit(self._start_node, node_id, node)
+                  for node_id, node in nodes]
+        futures.wait(starts)
+        nodes = [f.result() for f in starts]
+
+        for i, j in manifest['edges']:
+            nodes[i].connect('localhost', nodes[j].daemon.port, nodes[j].id())
+        wait_for(lambda: all(nodes[i].check_channel(nodes[j]) and nodes[j].check_channel(nodes[i])
+                             for i, j in manifest['edges']), timeout=60)
+        return nodes
+
+    def checkpoint(self, name, build):
+        """Return the nodes built by `build`, restoring them if we can.
+
+        `build` is called with the factory and returns the nodes of the
+        network. Its result is snapshotted, so that later tests of this
+        session asking for the same `name` skip building it.
+
+        """
+        if not self.has_snapshot(name):
+            self.snapshot(name, build(self))
+        return self.restore(name)
+
+    def _run_all(self, calls):
+        """Run `calls` concurrently, raising the first exception if any."""
+        running = [self.executor.submit(call) for call in calls]
+        futures.wait(running)
+        for f in running:
+            f.result()
+
+    def build(self, implementations, edges):
+        """Start a network of `implementations` with the channels in `edges`.
+
+        `edges` is a list of `(i, j, capacity)` tuples, with `i` and `j`
+        indices into `implementations`, and node `i` funding a channel
+        of `capacity` satoshis to node `j`. Every step is done for all
+        channels at once: the nodes are connected concurrently, all
+        openers are funded by a single transaction and the channels
+        confirm in the same blocks. Returns the nodes, in the order of
+        `implementations`, once all channels are active.
+
+        """
+        nodes = self.get_nodes(implementations)
+        rpc = self.bitcoind.rpc
+        pairs = sorted({(i, j) for i, j, _ in edges})
+
+        self._run_all([
+            lambda i=i, j=j: nodes[i].connect('localhost', nodes[j].daemon.port, nodes[j].id())
+            for i, j in pairs
+        ])
+
+        wait_for(lambda: all(nodes[j].id() in nodes[i].peers() for i, j in pairs))
+
+        # Fund each channel with its own output, twice the capacity to
+        # leave room for fees. Nodes that can't give us an address fund
+        # their channels themselves right before opening them.
+        outputs = collections.Counter()
+        funds = collections.Counter()
+        self_funded = set()
+        for i, j, capacity in edges:
+            try:
+                outputs[nodes[i].getaddress()] += 2 * capacity
+                funds[i] += 2 * capacity
+            except NotImplementedError:
+                self_funded.add(i)
+        addr = rpc.getnewaddress()
+        if outputs:
+            with rpc.batch() as b:
+                b.sendmany("", {a: float(amount) / 10**8 for a, amount in outputs.items()})
+                b.generatetoaddress(1, addr)
+            b.results()
+            sync_blockheight(self.bitcoind, nodes)
+            self._run_all([lambda i=i: nodes[i].wait_for_funds(funds[i]) for i in funds])
+
+        # A node opens its channels one after the other so they don't
+        # compete for the same outputs, but all nodes open at once.
+        channels = collections.defaultdict(list)
+        for i, j, capacity in edges:
+            channels[i].append((j, capacity))
+
+        def open_channels(i):
+            for j, capacity in channels[i]:
+                if i in self_funded:
+                    nodes[i].addfunds(self.bitcoind, 2 * capacity)
+                nodes[i].openchannel(nodes[j].id(), 'localhost', nodes[j].daemon.port, capacity)
+        self._run_all([lambda i=i: open_channels(i) for i in channels])
+
+        for _ in range(30):
+            time.sleep(2)
+            if all(nodes[i].check_channel(nodes[j]) and nodes[j].check_channel(nodes[i])
+                   for i, j in pairs):
+                return nodes
+            bhash = rpc.generatetoaddress(1, addr)[0]
+            self._run_all([lambda n=n: n.block_sync(bhash) for n in nodes])
+        raise ValueError("Channels are still not active after 30 blocks")
+
     def killall(self):
         for n in self.nodes:
             n.daemon.stop()
@@ -89,10 +445,45 @@ def test_name(request):
     yield request.function.__name__
 
     
-@pytest.fixture()
-def bitcoind(directory):
+@pytest.fixture(scope="session")
+def bitcoind_snapshot(test_base_dir):
+    """Build a funded, segwit-active regtest datadir once per session.
+
+    Mining the initial blocks is the same for every test, so we do it
+    once and let the `bitcoind` fixture clone the result. The snapshot
+    is keyed by the bitcoind version and its configuration.
+
+    """
+    config = [(k, v) for k, v in BITCOIND_CONFIG.items() if k != 'rpcport']
+    key = json.dumps([bitcoind_version(), config]).encode('UTF-8')
+    directory = os.path.join(
+        test_base_dir, "bitcoind-snapshot-{}".format(sha256(key).hexdigest()[:16]))
+
+    btc = BitcoinD(bitcoin_dir=directory)
+    btc.start()
+    addr = btc.rpc.getnewaddress()
+    btc.rpc.generatetoaddress(120, addr)
+    btc.rpc.stop()
+    btc.proc.wait()
+
+    yield os.path.join(directory, "regtest")
+
+    shutil.rmtree(directory)
+
+
+def start_bitcoind(bitcoin_dir, snapshot):
+    """Start a `ProxiedBitcoinD` in `bitcoin_dir` from the chain `snapshot`.
+    """
     proxyport = reserve()
-    btc = ProxiedBitcoinD(bitcoin_dir=os.path.join(directory, "bitcoind"), proxyport=proxyport)
+    regtest_dir = os.path.join(bitcoin_dir, "regtest")
+    clone_dir(snapshot, regtest_dir)
+    if os.path.exists(os.path.join(regtest_dir, "debug.log")):
+        os.remove(os.path.join(regtest_dir, "debug.log"))
+    proxy_class = AsyncProxiedBitcoinD if TEST_ASYNC_PROXY else ProxiedBitcoinD
+    btc = proxy_class(bitcoin_dir=bitcoin_dir, proxyport=proxyport)
+    if TEST_PROXY_CACHE:
+        btc.enable_cache()
+    btc.identify_clients = TEST_PROXY_CLIENTS
     btc.start()
     bch_info = btc.rpc.getblockchaininfo()
     w_info = btc.rpc.getwalletinfo()
@@ -104,15 +495,33 @@ def bitcoind(directory):
     elif w_info['balance'] < 1:
         logging.debug("Insufficient balance, generating 1 block")
         btc.rpc.generatetoaddress(1, addr)
+    return btc
 
-    # Mock `estimatesmartfee` to make c-lightning happy
-    def mock_estimatesmartfee(r):
-        return {"id": r['id'], "error": None, "result": {"feerate": 0.00100001, "blocks": r['params'][0]}}
 
-    btc.mock_rpc('estimatesmartfee', mock_estimatesmartfee)
+def uses_zmq(request):
+    """Whether the test runs nodes that follow bitcoind over ZMQ.
 
-    yield btc
+    Journals only stand in for the JSON-RPC interface, so these tests
+    always need a real bitcoind.
+    """
+    callspec = getattr(request.node, 'callspec', None)
+    impls = []
+    for param in (callspec.params.values() if callspec else []):
+        impls.extend(param if isinstance(param, (list, tuple)) else [param])
+    return any(getattr(impl, 'uses_zmq', False) for impl in impls)
 
+
+def replay_bitcoind(bitcoin_dir, journal):
+    """Start a proxy that answers from `journal` in place of bitcoind.
+    """
+    proxy_class = AsyncProxiedBitcoinD if TEST_ASYNC_PROXY else ProxiedBitcoinD
+    btc = proxy_class(bitcoin_dir=bitcoin_dir, proxyport=reserve())
+    btc.replay(journal)
+    btc.start()
+    return btc
+
+
+def stop_bitcoind(btc):
     try:
         btc.rpc.stop()
     except Exception:
@@ -120,6 +529,119 @@ def bitcoind(directory):
     btc.proc.wait()
 
 
+def wallet_rpc(btc, wallet):
+    """Return a `BitcoinRpc` bound to the bitcoind wallet `wallet`."""
+    return BitcoinRpc(url="http://localhost:{}/wallet/{}".format(btc.proxiedport, quote(wallet)),
+                      rpcuser='rpcuser', rpcpassword='rpcpass')
+
+
+@pytest.fixture(scope="session")
+def shared_bitcoind(request, test_base_dir):
+    """A bitcoind shared by all tests of this worker if TEST_SHARED_BITCOIND=1.
+
+    The funds of the default wallet are moved to a named funder wallet,
+    and the default wallet is unloaded. Between tests only the funder
+    wallet is loaded, while a test is running only its own wallet is.
+    The funder also mines 101 blocks, so that from then on every block
+    mined between tests matures one of its coinbases.
+
+    """
+    if not TEST_SHARED_BITCOIND or TEST_BITCOIND_JOURNAL == "replay":
+        yield None
+        return
+
+    btc = start_bitcoind(os.path.join(test_base_dir, "bitcoind-shared"),
+                         request.getfixturevalue('bitcoind_snapshot'))
+    btc.rpc.createwallet(FUNDER_WALLET)
+    funder = wallet_rpc(btc, FUNDER_WALLET)
+    default = wallet_rpc(btc, "")
+    default.sendtoaddress(funder.getnewaddress(), default.getbalance(), "", "", True)
+    default.generatetoaddress(101, funder.getnewaddress())
+    default.unloadwallet()
+    btc.base_rpc = btc.rpc
+
+    yield btc
+
+    stop_bitcoind(btc)
+
+
+@pytest.fixture()
+def bitcoind(request, directory, shared_bitcoind):
+    # The snapshot is only built if a test needs a real bitcoind, so a
+    # session that replays journals doesn't start bitcoind at all.
+    journal = os.path.join(JOURNAL_DIR, "{}.jsonl.gz".format(request.node.name))
+    journaled = TEST_BITCOIND_JOURNAL and not uses_zmq(request)
+    replay = journaled and TEST_BITCOIND_JOURNAL == "replay" and os.path.exists(journal)
+    if replay:
+        btc = replay_bitcoind(os.path.join(directory, "bitcoind"), journal)
+    elif shared_bitcoind is None:
+        btc = start_bitcoind(os.path.join(directory, "bitcoind"),
+                             request.getfixturevalue('bitcoind_snapshot'))
+    else:
+        # Give the test its own funded wallet, and unload the funder so
+        # that the test wallet is the only one, even for clients that
+        # do not go through the proxy.
+        btc = shared_bitcoind
+        wallet = os.path.basename(directory)
+        btc.base_rpc.createwallet(wallet)
+        funder = wallet_rpc(btc, FUNDER_WALLET)
+        btc.rpc = wallet_rpc(btc, wallet)
+        funder.sendtoaddress(btc.rpc.getnewaddress(), TEST_WALLET_FUNDS)
+        funder.generatetoaddress(1, funder.getnewaddress())
+        funder.unloadwallet()
+        btc.use_wallet(wallet)
+        btc.reset_metrics()
+
+    # Mock `estimatesmartfee` to make c-lightning happy
+    def mock_estimatesmartfee(r):
+        return {"id": r['id'], "error": None, "result": {"feerate": 0.00100001, "blocks": r['params'][0]}}
+
+    btc.mock_rpc('estimatesmartfee', mock_estimatesmartfee)
+
+    if journaled and TEST_BITCOIND_JOURNAL == "record":
+        # Send the calls of the test itself through the proxy as well,
+        # so they're recorded and can be replayed.
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        btc.record(journal)
+        btc.rpc = BitcoinRpc(rpcport=btc.rpcport, rpcuser='rpcuser', rpcpassword='rpcpass')
+
+    yield btc
+
+    btc.stop_recording()
+
+    # Export the proxy metrics, conftest attaches them to the test report.
+    metrics = btc.metrics.to_json()
+    request.node.bitcoind_metrics = metrics
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "bitcoind-metrics.json"), "w") as f:
+        json.dump(metrics, f, indent=4, sort_keys=True)
+
+    if replay:
+        btc.stop()
+    elif shared_bitcoind is None:
+        stop_bitcoind(btc)
+    else:
+        btc.mocks = {}
+        btc.shapes = {}
+        btc.limit_rate(None)
+        btc.use_wallet(None)
+        btc.rpc = btc.base_rpc
+        btc.rpc.loadwallet(FUNDER_WALLET)
+
+        # Give what is left back to the funder, and confirm it so the
+        # next test can use it.
+        test_wallet = wallet_rpc(btc, wallet)
+        funder = wallet_rpc(btc, FUNDER_WALLET)
+        balance = test_wallet.getbalance()
+        if balance > 0:
+            try:
+                test_wallet.sendtoaddress(funder.getnewaddress(), balance, "", "", True)
+            except Exception:
+                logging.exception("Could not return %s BTC to the funder", balance)
+        funder.generatetoaddress(1, funder.getnewaddress())
+        test_wallet.unloadwallet()
+
+
 @pytest.fixture(scope="module")
 def btcd():
     btcd = BtcD()
@@ -134,10 +656,25 @@ def btcd():
     btcd.proc.wait()
 
 
+@pytest.fixture(scope="session")
+def node_pool(shared_bitcoind):
+    """A `NodePool` shared by all tests of this worker if TEST_NODE_POOL is set.
+    """
+    if not TEST_NODE_POOL or shared_bitcoind is None:
+        yield None
+        return
+
+    pool = NodePool(os.path.join(TEST_DIR, "pool"), shared_bitcoind, TEST_NODE_POOL)
+
+    yield pool
+
+    pool.close()
+
+
 @pytest.fixture
-def node_factory(request, bitcoind):
+def node_factory(request, bitcoind, node_pool):
     executor = futures.ThreadPoolExecutor(max_workers=20)
-    node_factory = NodeFactory(request._pyfuncitem.name, executor, bitcoind, None)
+    node_factory = NodeFactory(request._pyfuncitem.name, executor, bitcoind, None, node_pool)
     yield node_factory
     node_factory.killall()
     executor.shutdown(wait=False)
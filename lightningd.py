@@ -1,5 +1,5 @@
 from lightning import LightningRpc
-from utils import TailableProc
+from utils import TailableProc, wait_for
 
 import json
 import logging
@@ -111,6 +111,13 @@ class LightningNode(object):
             time.sleep(1)
             bitcoind.rpc.generatetoaddress(1, btc_addr)
 
+    def wait_for_funds(self, satoshis):
+        """Wait until the wallet has confirmed outputs worth `satoshis`."""
+        def confirmed():
+            outputs = self.rpc.listfunds()['outputs']
+            return sum(o['value'] for o in outputs if o.get('status', 'confirmed') == 'confirmed') >= satoshis
+        wait_for(confirmed, timeout=60)
+
     def ping(self):
         """ Simple liveness test to see if the node is up and running
 
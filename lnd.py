@@ -1,6 +1,6 @@
 from binascii import hexlify
 from lnaddr import lndecode
-from utils import TailableProc, BITCOIND_CONFIG
+from utils import TailableProc, BITCOIND_CONFIG, wait_for
 import rpc_pb2_grpc as lnrpc_grpc
 import rpc_pb2 as lnrpc
 from ephemeral_port_reserve import reserve
@@ -61,8 +61,10 @@ class LndD(TailableProc):
 
     def start(self):
         super().start()
-        self.wait_for_log('RPC server listening on')
-        self.wait_for_log('Done catching up block hashes')
+        self.wait_for_logs([
+            'RPC server listening on',
+            'Done catching up block hashes',
+        ])
         time.sleep(5)
 
         logging.info('LND started (pid: {})'.format(self.proc.pid))
@@ -79,6 +81,8 @@ class LndD(TailableProc):
 class LndNode(object):
 
     displayName = 'lnd'
+    # Follows bitcoind over ZMQ, which replayed journals can't provide
+    uses_zmq = True
 
     def __init__(self, lightning_dir, lightning_port, bitcoind, executor=None, node_id=0):
         self.bitcoin = bitcoind
@@ -125,9 +129,12 @@ class LndNode(object):
         self.logger.debug("Channel {} -> {} state: {}".format(self_id, remote_id, channel))
         return channel.active
 
-    def addfunds(self, bitcoind, satoshis):
+    def getaddress(self):
         req = lnrpc.NewAddressRequest(type=1)
-        addr = self.rpc.stub.NewAddress(req).address
+        return self.rpc.stub.NewAddress(req).address
+
+    def addfunds(self, bitcoind, satoshis):
+        addr = self.getaddress()
         btc_addr = bitcoind.rpc.getnewaddress()
         bitcoind.rpc.sendtoaddress(addr, float(satoshis) / 10**8)
         self.daemon.wait_for_log("Inserting unconfirmed transaction")
@@ -142,6 +149,15 @@ class LndNode(object):
             i += 1
         assert(self.rpc.stub.WalletBalance(lnrpc.WalletBalanceRequest()).total_balance == satoshis)
 
+    def wait_for_funds(self, satoshis):
+        """Wait until the wallet's confirmed balance reaches `satoshis`.
+
+        `GetInfo` reports bitcoind's height, not how far the wallet got,
+        so we have to ask the wallet itself.
+        """
+        wait_for(lambda: self.rpc.stub.WalletBalance(
+            lnrpc.WalletBalanceRequest()).confirmed_balance >= satoshis, timeout=60)
+
     def openchannel(self, node_id, host, port, satoshis):
         peers = self.rpc.stub.ListPeers(lnrpc.ListPeersRequest()).peers
         peers_by_pubkey = {p.pub_key: p for p in peers}
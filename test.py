@@ -9,7 +9,7 @@ from lnaddr import lndecode
 from lnd import LndNode
 from ptarmd import PtarmNode
 from concurrent import futures
-from utils import BitcoinD, BtcD
+from utils import BitcoinD, BtcD, sync_blockheight, wait_for
 from bech32 import bech32_decode
 
 from fixtures import *
@@ -35,26 +35,11 @@ def transact_and_mine(btc):
     """
     addr = btc.rpc.getnewaddress()
     for i in range(10):
-        for j in range(10):
-            txid = btc.rpc.sendtoaddress(addr, 0.5)
-        btc.rpc.generatetoaddress(1, addr)
-
-
-def wait_for(success, timeout=30, interval=1):
-    start_time = time.time()
-    while not success() and time.time() < start_time + timeout:
-        time.sleep(interval)
-    if time.time() > start_time + timeout:
-        raise ValueError("Error waiting for {}", success)
-
-
-def sync_blockheight(btc, nodes):
-    info = btc.rpc.getblockchaininfo()
-    blocks = info['blocks']
-
-    print("Waiting for %d nodes to blockheight %d" % (len(nodes), blocks))
-    for n in nodes:
-        wait_for(lambda: n.info()['blockheight'] == blocks, interval=1)
+        with btc.rpc.batch() as b:
+            for j in range(10):
+                b.sendtoaddress(addr, 0.5)
+            b.generatetoaddress(1, addr)
+        b.results()
 
 
 def generate_until(btc, success, blocks=30, interval=1):
@@ -88,8 +73,7 @@ def test_start(bitcoind, node_factory, impl):
 
 @pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
 def test_connect(node_factory, bitcoind, impls):
-    node1 = node_factory.get_node(implementation=impls[0])
-    node2 = node_factory.get_node(implementation=impls[1])
+    node1, node2 = node_factory.get_nodes(impls)
 
     # Needed by lnd in order to have at least one block in the last 2 hours
     addr = bitcoind.rpc.getnewaddress()
@@ -128,8 +112,7 @@ def confirm_channel(bitcoind, n1, n2):
 
 @pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
 def test_open_channel(bitcoind, node_factory, impls):
-    node1 = node_factory.get_node(implementation=impls[0])
-    node2 = node_factory.get_node(implementation=impls[1])
+    node1, node2 = node_factory.get_nodes(impls)
 
     node1.connect('localhost', node2.daemon.port, node2.id())
 
@@ -156,17 +139,11 @@ def test_open_channel(bitcoind, node_factory, impls):
 def test_gossip(node_factory, bitcoind, impls):
     """ Create a network of lightningd nodes and connect to it using 2 new nodes
     """
-    # These are the nodes we really want to test
-    node1 = node_factory.get_node(implementation=impls[0])
-    node2 = node_factory.get_node(implementation=impls[1])
-
-    # Using lightningd since it is quickest to start up
-    nodes = [node_factory.get_node(implementation=LightningNode) for _ in range(5)]
-    for n1, n2 in zip(nodes[:4], nodes[1:]):
-        n1.connect('localhost', n2.daemon.port, n2.id())
-        n1.addfunds(bitcoind, 2 * 10**7)
-        n1.openchannel(n2.id(), 'localhost', n2.daemon.port, 10**7)
-        assert confirm_channel(bitcoind, n1, n2)
+    # The first two are the nodes we really want to test, the line graph
+    # uses lightningd since it is quickest to start up
+    node1, node2, *nodes = node_factory.build(
+        list(impls) + [LightningNode] * 5,
+        [(i, i + 1, 10**7) for i in range(2, 6)])
 
     time.sleep(5)
     addr = bitcoind.rpc.getnewaddress()
@@ -180,7 +157,7 @@ def test_gossip(node_factory, bitcoind, impls):
 
     # Now connect the first node to the line graph and the second one to the first
     node1.connect('localhost', nodes[0].daemon.port, nodes[0].id())
-    node2.connect('localhost', n1.daemon.port, n1.id())
+    node2.connect('localhost', nodes[3].daemon.port, nodes[3].id())
 
     # They should now be syncing as well
     # TODO(cdecker) Uncomment the following line when eclair exposes non-local channels as well (ACINQ/eclair/issues/126)
@@ -208,8 +185,7 @@ def test_invoice_decode(node_factory, impl):
 
 @pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
 def test_direct_payment(bitcoind, node_factory, impls):
-    node1 = node_factory.get_node(implementation=impls[0])
-    node2 = node_factory.get_node(implementation=impls[1])
+    node1, node2 = node_factory.get_nodes(impls)
     capacity = 10**7
 
     node1.connect('localhost', node2.daemon.port, node2.id())
@@ -237,6 +213,22 @@ def test_direct_payment(bitcoind, node_factory, impls):
     assert(sha256(unhexlify(payment_key)).digest() == dec.paymenthash)
 
 
+@pytest.mark.skipif(TEST_SHARED_BITCOIND, reason="Snapshots need a bitcoind of their own")
+@pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
+def test_checkpoint_payment(bitcoind, node_factory, impls):
+    capacity = 10**7
+    node1, node2 = node_factory.checkpoint(
+        "channel-{}".format(idfn(impls)),
+        lambda factory: factory.build(impls, [(0, 1, capacity)]))
+
+    amount = int(capacity / 10)
+    req = node2.invoice(amount)
+    dec = lndecode(req)
+
+    payment_key = node1.send(req)
+    assert(sha256(unhexlify(payment_key)).digest() == dec.paymenthash)
+
+
 def gossip_is_synced(nodes, num_channels):
     print("Checking %d nodes for gossip sync" % (len(nodes)))
     for i, n in enumerate(nodes):
@@ -268,16 +260,8 @@ def node_has_route(node, channels):
 @pytest.mark.parametrize("impls", product(impls, repeat=3), ids=idfn)
 def test_forwarded_payment(bitcoind, node_factory, impls):
     num_nodes = len(impls)
-    nodes = [node_factory.get_node(implementation=impls[i]) for i in range(3)]
     capacity = 10**7
-
-    for i in range(num_nodes-1):
-        nodes[i].connect('localhost', nodes[i+1].daemon.port, nodes[i+1].id())
-        nodes[i].addfunds(bitcoind, 4 * capacity)
-
-    for i in range(num_nodes-1):
-        nodes[i].openchannel(nodes[i+1].id(), 'localhost', nodes[i+1].daemon.port, capacity)
-        assert confirm_channel(bitcoind, nodes[i], nodes[i+1])
+    nodes = node_factory.build(impls, [(i, i + 1, capacity) for i in range(num_nodes - 1)])
 
     addr = bitcoind.rpc.getnewaddress()
     bitcoind.rpc.generatetoaddress(6, addr)
@@ -304,8 +288,7 @@ def test_forwarded_payment(bitcoind, node_factory, impls):
 
 @pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
 def test_reconnect(bitcoind, node_factory, impls):
-    node1 = node_factory.get_node(implementation=impls[0])
-    node2 = node_factory.get_node(implementation=impls[1])
+    node1, node2 = node_factory.get_nodes(impls)
     capacity = 10**7
 
     node1.connect('localhost', node2.daemon.port, node2.id())
@@ -358,8 +341,7 @@ def test_reconnect(bitcoind, node_factory, impls):
 
 @pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
 def test_reconnect_across_channel_open(bitcoind, node_factory, impls):
-    node1 = node_factory.get_node(implementation=impls[0])
-    node2 = node_factory.get_node(implementation=impls[1])
+    node1, node2 = node_factory.get_nodes(impls)
     capacity = 10**7
 
     node1.connect('localhost', node2.daemon.port, node2.id())
@@ -1,5 +1,7 @@
 from bitcoin.rpc import RawProxy as BitcoinProxy
 from ephemeral_port_reserve import reserve
+from requests.adapters import HTTPAdapter
+from concurrent import futures
 
 import logging
 import re
@@ -11,6 +13,23 @@ import collections
 import json
 import base64
 import requests
+import itertools
+import selectors
+import mmap
+import tempfile
+import gzip
+import shutil
+from array import array
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 
 BITCOIND_CONFIG = collections.OrderedDict([
@@ -24,6 +43,10 @@ BITCOIND_CONFIG = collections.OrderedDict([
     ("listen", 0),
 ])
 
+# Compression used for the persisted daemon logs: '' (plain), 'gzip' or
+# 'zstd' (requires the `zstandard` package).
+LOG_COMPRESSION = os.getenv("TEST_LOG_COMPRESSION", "")
+
 
 def write_config(filename, opts):
     with open(filename, 'w') as f:
@@ -38,6 +61,436 @@ def write_dict(f, opts):
             f.write("{}={}\n".format(k, v))
 
 
+# A single line of daemon output, decoded once, along with the
+# `time.monotonic()` timestamp at which it was read from the process.
+LogLine = collections.namedtuple('LogLine', ['timestamp', 'text'])
+
+
+def clone_dir(src, dst):
+    """Copy the directory `src` to `dst`, sharing data where possible.
+
+    We ask `cp` for a reflink copy, so on copy-on-write filesystems
+    (btrfs, xfs, ...) the clone is nearly free, and fall back to a
+    plain copy otherwise. Hardlinks are not an option since bitcoind
+    and the Lightning daemons modify some of their files in place.
+    """
+    os.makedirs(os.path.dirname(os.path.normpath(dst)), exist_ok=True)
+    try:
+        subprocess.check_call(['cp', '-a', '--reflink=auto', src, dst])
+    except (OSError, subprocess.CalledProcessError):
+        shutil.copytree(src, dst, symlinks=True)
+
+
+def wait_ready(probe, timeout=10, interval=0.01, max_interval=0.5, proc=None):
+    """Call `probe` with exponential backoff until it succeeds.
+
+    `probe` signals that the service is not ready yet by raising an
+    exception. The first successful result is returned. We give up
+    with a `TimeoutError` after `timeout` seconds, or with a
+    `ValueError` as soon as the `TailableProc` `proc` exits.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return probe()
+        except Exception as e:
+            if proc is not None and not proc.running:
+                raise ValueError('Process died while waiting for it to be ready')
+            if time.time() + interval > deadline:
+                raise TimeoutError('Not ready after {}s: {}'.format(timeout, e))
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+
+def wait_for(success, timeout=30, interval=1):
+    start_time = time.time()
+    while not success() and time.time() < start_time + timeout:
+        time.sleep(interval)
+    if time.time() > start_time + timeout:
+        raise ValueError("Error waiting for {}", success)
+
+
+def sync_blockheight(btc, nodes):
+    info = btc.rpc.getblockchaininfo()
+    blocks = info['blocks']
+
+    print("Waiting for %d nodes to blockheight %d" % (len(nodes), blocks))
+    for n in nodes:
+        wait_for(lambda: n.info()['blockheight'] == blocks, interval=1)
+
+
+def bitcoind_version():
+    """Return the version string of the `bitcoind` binary we test against."""
+    out = subprocess.check_output(['bitcoind', '-version'])
+    return out.decode('UTF-8').split('\n')[0].strip()
+
+
+class LogStore(object):
+    """An append-only log that keeps only the most recent lines in memory.
+
+    The last `capacity` lines are kept in an in-memory ring. Older
+    lines are spilled to an anonymous append-only file, which is
+    memory-mapped for reading, so lookups on the full history keep
+    working while memory usage stays flat no matter how verbose the
+    daemon is. A sparse index of the offset of every `INDEX_STRIDE`th
+    spilled line provides random access into the file.
+
+    The store itself is not thread-safe, `TailableProc` guards it with
+    its `logs_cond`.
+    """
+
+    INDEX_STRIDE = 64
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.ring = collections.deque()
+        self.spilled = 0
+        self.spill_file = None
+        self.spill_size = 0
+        self.index = array('Q')
+        self.map = None
+
+    def __len__(self):
+        return self.spilled + len(self.ring)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('log line index out of range')
+        if i >= self.spilled:
+            return self.ring[i - self.spilled]
+        for _, line in self.lines(i, i + 1):
+            return line
+
+    def __iter__(self):
+        for _, line in self.lines():
+            yield line
+
+    def position_at(self, timestamp):
+        """Return the position of the first line read at or after `timestamp`.
+
+        Lines are appended in arrival order, so their timestamps are
+        non-decreasing and we can bisect.
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid].timestamp < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def append(self, line):
+        if len(self.ring) >= self.capacity:
+            self._spill(self.ring.popleft())
+        self.ring.append(line)
+
+    def _spill(self, line):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix='log-spill-')
+            if self.map is not None:
+                # Reopened after `close`, carry over what was spilled
+                self.spill_file.write(self.map[:self.spill_size])
+                self.map.close()
+                self.map = None
+        if self.spilled % self.INDEX_STRIDE == 0:
+            self.index.append(self.spill_size)
+        data = '{!r} {}\n'.format(line.timestamp, line.text).encode('UTF-8')
+        self.spill_file.write(data)
+        self.spill_size += len(data)
+        self.spilled += 1
+
+    def _mapped(self):
+        """Return a memory map covering everything spilled so far."""
+        if self.spill_file is not None and (self.map is None or len(self.map) < self.spill_size):
+            self.spill_file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.spill_file.fileno(), self.spill_size,
+                                 access=mmap.ACCESS_READ)
+        return self.map
+
+    def lines(self, start=0, end=None):
+        """Iterate over `(position, line)` for lines in `[start, end)`.
+
+        Spilled lines are read sequentially from the memory map,
+        starting at the closest indexed offset.
+        """
+        end = len(self) if end is None else min(end, len(self))
+        pos = max(start, 0)
+        if pos < min(end, self.spilled):
+            m = self._mapped()
+            block = pos // self.INDEX_STRIDE
+            i, offset = block * self.INDEX_STRIDE, self.index[block]
+            while i < min(end, self.spilled):
+                nl = m.find(b'\n', offset)
+                if i >= pos:
+                    timestamp, _, text = m[offset:nl].decode('UTF-8').partition(' ')
+                    yield i, LogLine(float(timestamp), text)
+                offset = nl + 1
+                i += 1
+            pos = i
+        while pos < end:
+            yield pos, self.ring[pos - self.spilled]
+            pos += 1
+
+    def close(self):
+        """Close the spill file once no more lines are expected.
+
+        Spilled lines stay readable through the memory map, and
+        appending more lines reopens the file.
+        """
+        if self.spill_file is not None:
+            if self.spill_size:
+                self._mapped()
+            self.spill_file.close()
+            self.spill_file = None
+
+
+class LogWriter(object):
+    """Stream log lines to disk as they arrive.
+
+    Lines are appended to `path` (with a `.gz` or `.zst` suffix if
+    compressed) and flushed at most every `FLUSH_INTERVAL` seconds. The
+    `LogMultiplexer` also flushes writers of daemons that went quiet,
+    so the file is usable even if the test runner gets killed, and
+    closing it at teardown is cheap. Both gzip and zstd streams are
+    flushed at block boundaries, so everything up to the last flush of
+    a file that was never closed can be recovered with a streaming
+    decompressor, e.g. `zcat` prints it before complaining about the
+    unexpected end of the file. Reading such a file with `gzip.open`
+    raises an `EOFError` though.
+    """
+
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, path, compression=LOG_COMPRESSION):
+        self.compression = compression
+        if compression == 'gzip':
+            self.path = path + '.gz'
+            self.f = gzip.open(self.path, 'ab')
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise ValueError("zstd log compression requires the zstandard package")
+            self.path = path + '.zst'
+            self.f = zstandard.ZstdCompressor().stream_writer(open(self.path, 'ab'))
+        elif not compression:
+            self.path = path
+            self.f = open(self.path, 'ab')
+        else:
+            raise ValueError("Unknown log compression {}".format(compression))
+        self.next_flush = time.time() + self.FLUSH_INTERVAL
+        self.dirty = False
+
+    def write(self, lines):
+        self.f.write(b''.join(text.encode('UTF-8') + b'\n' for text in lines))
+        self.dirty = True
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if self.dirty and time.time() >= self.next_flush:
+            self.flush()
+
+    def flush(self):
+        if self.compression == 'zstd':
+            self.f.flush(zstandard.FLUSH_BLOCK)
+        else:
+            self.f.flush()
+        self.next_flush = time.time() + self.FLUSH_INTERVAL
+        self.dirty = False
+
+    def close(self):
+        self.f.close()
+
+
+# Where a pattern matched: the position of the line in the log and the
+# `LogLine` itself.
+LogMatch = collections.namedtuple('LogMatch', ['pos', 'line'])
+
+
+class LogWaiter(object):
+    """A pending `wait_for_logs` call, resolved by the tailing thread.
+
+    The waiter is registered with the `LogMatcher` and each new line
+    is checked against its outstanding patterns exactly once, so
+    waiting does not require rescanning the log. With `mode='all'` the
+    waiter is done once every pattern matched, with `mode='any'` as
+    soon as one did.
+    """
+
+    def __init__(self, patterns, mode='all'):
+        if mode not in ('all', 'any'):
+            raise ValueError("Unknown wait mode {}".format(mode))
+        self.pending = collections.OrderedDict(patterns)
+        self.matches = collections.OrderedDict()
+        self.mode = mode
+
+    @property
+    def done(self):
+        if self.mode == 'any':
+            return len(self.matches) > 0
+        return len(self.pending) == 0
+
+    def match(self, pos, line):
+        for regex, ex in list(self.pending.items()):
+            if ex.search(line.text):
+                self.matches[regex] = LogMatch(pos, line)
+                del self.pending[regex]
+        return self.done
+
+
+class LogMatcher(object):
+    """Compiled patterns, scan cursors and outstanding waiters for a log.
+
+    Patterns are compiled once and cached. `is_in_log` keeps a cursor
+    per pattern so that repeated lookups only look at lines that were
+    added since the last call, and `wait_for_log` registers a
+    `LogWaiter` that is checked whenever a new line arrives.
+    """
+
+    def __init__(self):
+        self.patterns = {}
+        self.cursors = {}
+        self.waiters = []
+
+    def compile(self, regex):
+        ex = self.patterns.get(regex)
+        if ex is None:
+            ex = self.patterns[regex] = re.compile(regex)
+        return ex
+
+    def search(self, regex, logs):
+        """Incrementally search `logs` for `regex`.
+
+        Returns the position of the first matching line, or None if
+        no line matched so far.
+        """
+        ex = self.compile(regex)
+        pos, found = self.cursors.get(regex, (0, None))
+        if found is None:
+            for i, line in logs.lines(pos):
+                if ex.search(line.text):
+                    found = i
+                    break
+            self.cursors[regex] = (len(logs), found)
+        return found
+
+    def register(self, waiter):
+        self.waiters.append(waiter)
+
+    def unregister(self, waiter):
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+
+    def feed(self, pos, line):
+        """Check a newly arrived line against all outstanding waiters."""
+        if not self.waiters:
+            return
+        self.waiters = [w for w in self.waiters if not w.match(pos, line)]
+
+
+class LogMultiplexer(object):
+    """Tail the stdout of all running daemons from a single thread.
+
+    Rather than spawning a thread per process doing blocking
+    `readline` calls, all pipes are registered with a selector and
+    read in large non-blocking chunks. Complete lines are split off
+    and handed to the owning `TailableProc` in batches. Every
+    `LogWriter.FLUSH_INTERVAL` we also flush the log files, so that
+    the last lines of a daemon that stopped talking reach the disk.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    READ_SIZE = 65536
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+        self.thread = threading.Thread(target=self.run, name='log-multiplexer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def get(cls):
+        """Return the shared multiplexer, starting it if necessary."""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def register(self, proc):
+        """Start tailing the stdout of `proc` (a `TailableProc`)."""
+        pipe = proc.proc.stdout
+        fd = pipe.fileno()
+        os.set_blocking(fd, False)
+        with self.lock:
+            self.pending.append((fd, proc, pipe))
+        os.write(self.wakeup_w, b'\0')
+
+    def _register_pending(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for fd, proc, pipe in pending:
+            self.selector.register(fd, selectors.EVENT_READ, [proc, b'', pipe])
+
+    def _read(self, key):
+        proc, partial, pipe = key.data
+        try:
+            chunk = os.read(key.fd, self.READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b''
+
+        if not chunk:
+            self.selector.unregister(key.fd)
+            pipe.close()
+            proc._tail_eof([partial] if partial else [], pipe)
+            return
+
+        lines = (partial + chunk).split(b'\n')
+        key.data[1] = lines.pop()
+        if lines:
+            proc._tail_lines(lines)
+
+    def _flush_logs(self):
+        for key in list(self.selector.get_map().values()):
+            if key.data is None:
+                continue
+            try:
+                key.data[0].flush_log()
+            except Exception:
+                logging.exception("Error flushing the log of fd %d", key.fd)
+
+    def run(self):
+        next_flush = time.time() + LogWriter.FLUSH_INTERVAL
+        while True:
+            for key, _ in self.selector.select(timeout=LogWriter.FLUSH_INTERVAL):
+                if key.data is None:
+                    self._register_pending()
+                    continue
+                try:
+                    self._read(key)
+                except Exception:
+                    logging.exception("Error tailing fd %d", key.fd)
+            if time.time() >= next_flush:
+                self._flush_logs()
+                next_flush = time.time() + LogWriter.FLUSH_INTERVAL
+
+
 class TailableProc(object):
     """A monitorable process that we can start, stop and tail.
 
@@ -45,61 +498,109 @@ class TailableProc(object):
     tail the processes and react to their output.
     """
 
+    # Number of recent log lines kept in memory, older ones are spilled
+    # to disk by the `LogStore`.
+    LOG_MEMORY_LINES = 10000
+
     def __init__(self, outputDir=None, prefix='proc'):
-        self.logs = []
+        self.logs = LogStore(self.LOG_MEMORY_LINES)
         self.logs_cond = threading.Condition(threading.RLock())
+        self.matcher = LogMatcher()
         self.cmd_line = None
         self.running = False
         self.proc = None
         self.outputDir = outputDir
+        self.log_writer = None
         self.logger = logging.getLogger(prefix)
 
     def start(self):
         """Start the underlying process and start monitoring it.
+
+        The stdout of the process is tailed by the shared
+        `LogMultiplexer` thread and streamed to `log.<timestamp>` in the
+        `outputDir`.
         """
-        self.thread = threading.Thread(target=self.tail)
-        self.thread.daemon = True
         logging.debug("Starting '%s'", " ".join(self.cmd_line))
+        if self.outputDir:
+            os.makedirs(self.outputDir, exist_ok=True)
+            logpath = os.path.join(self.outputDir, 'log.' + str(int(time.time())))
+            with self.logs_cond:
+                self.save_log()
+                self.log_writer = LogWriter(logpath)
         self.proc = subprocess.Popen(self.cmd_line, stdout=subprocess.PIPE)
-        self.thread.start()
+        self.tail_done = threading.Event()
         self.running = True
+        LogMultiplexer.get().register(self)
 
     def save_log(self):
-        if self.outputDir:
-            logpath = os.path.join(self.outputDir, 'log.' + str(int(time.time())))
-            with open(logpath, 'w') as f:
-                for l in self.logs:
-                    f.write(l + '\n')
+        """Finish writing the log file.
+
+        Lines are streamed to disk as they arrive, so all that is left
+        to do is flushing and closing the file.
+        """
+        with self.logs_cond:
+            if self.log_writer is not None:
+                self.log_writer.close()
+                self.log_writer = None
+
+    def flush_log(self):
+        """Flush lines not yet written to disk, if they are due."""
+        with self.logs_cond:
+            if self.log_writer is not None:
+                self.log_writer.flush_if_due()
 
     def stop(self):
         self.proc.terminate()
         self.proc.kill()
         self.save_log()
 
-    def tail(self):
-        """Tail the stdout of the process and remember it.
+    def _tail_lines(self, lines):
+        """Remember a batch of lines read from the stdout of the process.
 
-        Stores the lines of output produced by the process in
-        self.logs and signals that a new line was read so that it can
-        be picked up by consumers.
+        Called from the `LogMultiplexer` thread. Each line is decoded
+        once and stored as a `LogLine` in self.logs, stamped with the
+        time the batch was read. Then we signal that new lines were
+        read so that they can be picked up by consumers.
         """
-        for line in iter(self.proc.stdout.readline, ''):
-            if len(line) == 0:
-                break
-            with self.logs_cond:
-                self.logs.append(str(line.rstrip()))
-                self.logger.debug(line.decode().rstrip())
-                self.logs_cond.notifyAll()
-        self.running = False
+        timestamp = time.monotonic()
+        texts = [line.decode('UTF-8', 'replace').rstrip() for line in lines]
+        with self.logs_cond:
+            for text in texts:
+                line = LogLine(timestamp, text)
+                self.logs.append(line)
+                self.matcher.feed(len(self.logs) - 1, line)
+                self.logger.debug(text)
+            if self.log_writer is not None:
+                self.log_writer.write(texts)
+            self.logs_cond.notifyAll()
+
+    def _tail_eof(self, lines, pipe):
+        """The process closed its stdout, flush what is left and stop.
+        """
+        self._tail_lines(lines)
+        if pipe is not self.proc.stdout:
+            # A previous incarnation of a restarted process
+            return
+        with self.logs_cond:
+            self.save_log()
+            self.logs.close()
+            self.running = False
+            self.logs_cond.notifyAll()
+        self.tail_done.set()
+
+    def join_tail(self, timeout=None):
+        """Wait until all output of the process has been read."""
+        return self.tail_done.wait(timeout)
 
     def is_in_log(self, regex):
         """Look for `regex` in the logs."""
 
-        ex = re.compile(regex)
-        for l in self.logs:
-            if ex.search(l):
-                logging.debug("Found '%s' in logs", regex)
-                return True
+        with self.logs_cond:
+            found = self.matcher.search(regex, self.logs)
+
+        if found is not None:
+            logging.debug("Found '%s' in logs", regex)
+            return True
 
         logging.debug("Did not find '%s' in logs", regex)
         return False
@@ -115,58 +616,168 @@ class TailableProc(object):
         effects.
 
         """
-        logging.debug("Waiting for '%s' in the logs", regex)
-        ex = re.compile(regex)
+        matches = self.wait_for_logs([regex], offset=offset, timeout=timeout)
+        return matches[regex].line.text
+
+    def wait_for_logs(self, regexs, mode='all', offset=1000, timeout=60):
+        """Look for several `regexs` in the logs in a single pass.
+
+        Works like `wait_for_log`, but waits until all (`mode='all'`)
+        or any (`mode='any'`) of the patterns matched. Returns a dict
+        mapping each matched pattern to a `LogMatch` with the position
+        and the line it first matched at.
+
+        The lines already in the log are scanned once, after that a
+        waiter is registered with the matcher and new lines are
+        checked by the tailing thread as they arrive.
+
+        """
+        logging.debug("Waiting for %s of %s in the logs", mode, regexs)
         start_time = time.time()
-        pos = max(len(self.logs) - offset, 0)
-        initial_pos = len(self.logs)
-        while True:
-            if time.time() > start_time + timeout:
-                print("Can't find {} in logs".format(regex))
-                with self.logs_cond:
-                    for i in range(initial_pos, len(self.logs)):
-                        print("  " + self.logs[i])
-                if self.is_in_log(regex):
-                    print("(Was previously in logs!")
-                raise TimeoutError(
-                    'Unable to find "{}" in logs.'.format(regex))
-            elif not self.running:
-                print('Logs: {}'.format(self.logs))
-                raise ValueError('Process died while waiting for logs')
 
-            with self.logs_cond:
-                if pos >= len(self.logs):
-                    self.logs_cond.wait(1)
-                    continue
+        with self.logs_cond:
+            waiter = LogWaiter([(r, self.matcher.compile(r)) for r in regexs], mode)
+            initial_pos = len(self.logs)
+            for pos, line in self.logs.lines(initial_pos - offset):
+                if waiter.match(pos, line):
+                    break
+
+            if not waiter.done:
+                self.matcher.register(waiter)
+            try:
+                while not waiter.done:
+                    remaining = start_time + timeout - time.time()
+                    if remaining <= 0:
+                        missing = list(waiter.pending)
+                        print("Can't find {} in logs".format(", ".join(missing)))
+                        for _, line in self.logs.lines(initial_pos):
+                            print("  " + line.text)
+                        if any(self.is_in_log(r) for r in missing):
+                            print("(Was previously in logs!")
+                        raise TimeoutError(
+                            'Unable to find "{}" in logs.'.format('", "'.join(missing)))
+                    elif not self.running:
+                        print('Logs: {}'.format([line.text for line in self.logs]))
+                        raise ValueError('Process died while waiting for logs')
+                    self.logs_cond.wait(min(remaining, 1))
+            finally:
+                self.matcher.unregister(waiter)
+
+        logging.debug("Found %s in logs", list(waiter.matches))
+        return dict(waiter.matches)
+
+    def wait_for_log_after(self, regex, since, timeout=60):
+        """Wait for the first line matching `regex` read at or after `since`.
+
+        `since` is a `time.monotonic()` timestamp, e.g., taken just
+        before issuing an RPC call. Returns the `LogMatch`, whose
+        `line.timestamp` tells us when the line arrived.
+        """
+        with self.logs_cond:
+            offset = len(self.logs) - self.logs.position_at(since)
+            return self.wait_for_logs([regex], offset=offset, timeout=timeout)[regex]
 
-                if ex.search(self.logs[pos]):
-                    logging.debug("Found '%s' in logs", regex)
-                    return self.logs[pos]
-                pos += 1
+
+def log_latencies(origin, targets, since=None, timeout=60):
+    """Measure how long it takes for a log event to show up elsewhere.
+
+    `origin` and each of the `targets` are `(proc, regex)` tuples. We
+    wait for the origin to log a line matching its pattern (at or after
+    the `time.monotonic()` timestamp `since` if given, otherwise within
+    the usual `wait_for_log` offset), and then for each target to log
+    a line matching its pattern after that. Returns the latencies in
+    seconds, in the order of `targets`, e.g., the time from bitcoind
+    logging a new tip until each Lightning daemon processed the block.
+
+    Timestamps are taken when the harness reads the line, so daemons
+    buffering their stdout will appear slower than they are.
+    """
+    proc, regex = origin
+    if since is None:
+        start = proc.wait_for_logs([regex], timeout=timeout)[regex]
+    else:
+        start = proc.wait_for_log_after(regex, since, timeout=timeout)
+
+    t0 = start.line.timestamp
+    latencies = []
+    for proc, regex in targets:
+        m = proc.wait_for_log_after(regex, t0, timeout=timeout)
+        latencies.append(m.line.timestamp - t0)
+    return latencies
 
 
 class BitcoinRpc(object):
+    """A minimal JSON-RPC client for bitcoind.
+
+    Each thread gets its own `requests.Session`, so calls reuse a
+    keep-alive connection instead of setting up a new TCP connection
+    and HTTP exchange every time, and no session is ever shared
+    between threads.
+    """
+
     def __init__(self, url=None, rpcport=8332, rpcuser=None, rpcpassword=None):
         self.url = url if url else "http://localhost:{}".format(rpcport)
         authpair = "%s:%s" % (rpcuser, rpcpassword)
         authpair = authpair.encode('utf8')
         self.auth_header = b"Basic " + base64.b64encode(authpair)
-        self.__id_count = 0
+        self.__id_count = itertools.count(1)
+        self.__local = threading.local()
+
+    def _session(self):
+        session = getattr(self.__local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.headers.update({
+                'Authorization': self.auth_header,
+                'Content-type': 'application/json',
+            })
+            self.__local.session = session
+        return session
+
+    def _batch_call(self, calls):
+        """Send a list of `(method, args)` calls in a single request.
+
+        Returns the raw JSON-RPC replies in the order of `calls`. If
+        bitcoind rejects the batch as a whole, it answers with a single
+        error instead, which we raise as a `ValueError`.
+        """
+        reqs = [{
+            'version': '1.1',
+            'method': method,
+            'params': args,
+            'id': next(self.__id_count)} for method, args in calls]
+        r = self._session().post(self.url, data=json.dumps(reqs))
+
+        response = r.json()
+        if not isinstance(response, list):
+            raise ValueError(response.get('error') or {
+                'code': -343, 'message': 'missing JSON-RPC result'})
+
+        replies = {reply['id']: reply for reply in response}
+        missing = {'error': {'code': -343, 'message': 'missing JSON-RPC result'}}
+        return [replies.get(req['id'], missing) for req in reqs]
+
+    def batch(self):
+        """Collect calls and send them in a single round trip.
+
+        Use as a context manager, the calls are sent when the block
+        exits::
+
+            with rpc.batch() as b:
+                txid = b.sendtoaddress(addr, 1)
+                b.generatetoaddress(1, addr)
+            print(txid.result())
+        """
+        return BitcoinRpcBatch(self)
 
     def _call(self, service_name, *args):
-        self.__id_count += 1
-
-        r = requests.post(self.url,
-                          data=json.dumps({
-                              'version': '1.1',
-                              'method': service_name,
-                              'params': args,
-                              'id': self.__id_count}),
-                          headers={
-                              # 'Host': self.__url.hostname,
-                              'Authorization': self.auth_header,
-                              'Content-type': 'application/json'
-                          })
+        r = self._session().post(self.url,
+                                 data=json.dumps({
+                                     'version': '1.1',
+                                     'method': service_name,
+                                     'params': args,
+                                     'id': next(self.__id_count)}))
 
         response = r.json()
         if response['error'] is not None:
@@ -190,6 +801,148 @@ class BitcoinRpc(object):
         return f
 
 
+class BitcoinRpcBatch(object):
+    """A batch of calls to be sent by `BitcoinRpc` in one request.
+
+    Calling a method on the batch returns a `Future` that is resolved
+    once the batch has been executed, either with the result or with
+    a `ValueError` carrying the JSON-RPC error.
+    """
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self.calls = []
+        self.pending = []
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def execute(self):
+        """Send all calls queued since the last execution."""
+        calls, fs = self.calls, self.pending
+        self.calls, self.pending = [], []
+        if not calls:
+            return
+
+        try:
+            replies = self.rpc._batch_call(calls)
+        except Exception as e:
+            for f in fs:
+                f.set_exception(e)
+            raise
+
+        for f, reply in zip(fs, replies):
+            if reply.get('error') is not None:
+                f.set_exception(ValueError(reply['error']))
+            elif 'result' not in reply:
+                f.set_exception(ValueError({
+                    'code': -343, 'message': 'missing JSON-RPC result'}))
+            else:
+                f.set_result(reply['result'])
+
+    def results(self):
+        """Return the results of all calls in the batch, in order.
+
+        Raises the error of the first call that failed.
+        """
+        return [f.result(timeout=0) for f in self.futures]
+
+    def __getattr__(self, name):
+        if name in self.__dict__:
+            return self.__dict__[name]
+
+        def f(*args):
+            future = futures.Future()
+            self.calls.append((name, args))
+            self.pending.append(future)
+            self.futures.append(future)
+            return future
+
+        f.__name__ = name
+        return f
+
+
+class AsyncBitcoinRpc(object):
+    """An asyncio flavour of `BitcoinRpc`.
+
+    Methods are looked up dynamically like on `BitcoinRpc`, but return
+    coroutines, so a test can fan out many calls to bitcoind with
+    `asyncio.gather` without spawning a thread per call. Connections
+    are kept alive and reused, and at most `max_concurrency` requests
+    are in flight at any time, further calls queue up for a free
+    connection.
+
+    The underlying session is bound to the event loop it was first
+    used in, so use the client as an async context manager::
+
+        async with bitcoind.async_rpc() as rpc:
+            addrs = await asyncio.gather(*[rpc.getnewaddress() for _ in range(10)])
+    """
+
+    def __init__(self, url=None, rpcport=8332, rpcuser=None, rpcpassword=None,
+                 max_concurrency=8):
+        if aiohttp is None:
+            raise ValueError("AsyncBitcoinRpc requires the aiohttp package")
+        self.url = url if url else "http://localhost:{}".format(rpcport)
+        self.auth = aiohttp.BasicAuth(rpcuser, rpcpassword)
+        self.max_concurrency = max_concurrency
+        self.__id_count = itertools.count(1)
+        self.__session = None
+
+    def _session(self):
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                auth=self.auth,
+                headers={'Content-type': 'application/json'},
+            )
+        return self.__session
+
+    async def _call(self, service_name, *args):
+        data = json.dumps({
+            'version': '1.1',
+            'method': service_name,
+            'params': args,
+            'id': next(self.__id_count)})
+        async with self._session().post(self.url, data=data) as r:
+            response = json.loads(await r.text())
+
+        if response['error'] is not None:
+            raise ValueError(response['error'])
+        elif 'result' not in response:
+            raise ValueError({
+                'code': -343, 'message': 'missing JSON-RPC result'})
+        else:
+            return response['result']
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __getattr__(self, name):
+        if name in self.__dict__:
+            return self.__dict__[name]
+
+        # Create a coroutine function to do the actual call
+        async def f(*args):
+            return await self._call(name, *args)
+
+        f.__name__ = name
+        return f
+
+
 class BitcoinD(TailableProc):
 
     CONF_NAME = 'bitcoin.conf'
@@ -237,10 +990,25 @@ class BitcoinD(TailableProc):
 
     def start(self):
         super().start()
-        self.wait_for_log("Done loading", timeout=10)
+        self.wait_for_rpc(timeout=10)
 
         logging.info("BitcoinD started")
 
+    def wait_for_rpc(self, timeout=10):
+        """Wait until bitcoind serves RPC calls.
+
+        bitcoind accepts connections early on, but answers with a
+        warmup error until it is done loading, so we probe with a real
+        call rather than just checking the port.
+        """
+        return wait_ready(self.rpc.getblockchaininfo, timeout=timeout, proc=self)
+
+    def async_rpc(self, max_concurrency=8):
+        """Return an `AsyncBitcoinRpc` talking to the same endpoint as `rpc`."""
+        return AsyncBitcoinRpc(url=self.rpc.url, rpcuser='rpcuser',
+                               rpcpassword='rpcpass',
+                               max_concurrency=max_concurrency)
+
 
 class BtcD(TailableProc):
 